@@ -1,33 +1,246 @@
 #!/usr/bin/env python3
 
 import os
+import io
 import sys
-import glob
-import time
+import stat
+import re
 import subprocess
 import argparse
+import logging
+import time
+import threading
+import contextlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try:
+    import esptool
+except ImportError:  # Sem o módulo, cai para o esptool.py via subprocess
+    esptool = None
+
+try:
+    # API de alto nível do esptool >= 5, que permite reutilizar uma conexão com o chip
+    from esptool.cmds import attach_flash, reset_chip, run_stub, verify_flash, write_flash
+    from esptool.targets import ESP32ROM
+except ImportError:
+    ESP32ROM = None
+
+try:
+    # Logger global do esptool >= 5, compartilhado por todas as threads
+    from esptool.logger import log as esptool_log
+except ImportError:
+    esptool_log = None
+
+# Tamanho dos blocos lidos da saída do esptool
+READ_BUFFER_SIZE = 65536
+LINE_BREAK = re.compile(rb"[\r\n]")
+TEXT_LINE_BREAK = re.compile(r"[\r\n]")
+ANSI_ESCAPE = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
+
+# Taxa de transmissão padrão e taxas menores tentadas quando a comunicação falha.
+# O sincronismo inicial do esptool é sempre a 115200; --baud só vale depois que o
+# esptool imprime "Changed.", então só erros de transferência vistos a partir daí
+# (e nunca "Failed to connect") justificam baixar a taxa.
+DEFAULT_BAUD = 921600
+BAUD_FALLBACK = (460800, 230400, 115200)
+BAUD_CHANGED = re.compile(r"^Changed\.$")
+BAUD_FAILURE = re.compile(
+    r"No serial data received|Serial data stream stopped|Packet content transfer stopped"
+    r"|Invalid head of packet|Timed out waiting for packet"  # a última é do esptool 4
+)
+
+# Caminhos dos arquivos de firmware, resolvidos e validados uma única vez em main()
+FirmwareBundle = namedtuple("FirmwareBundle", "bootloader partitions firmware sizes")
+
+logger = logging.getLogger("flasher")
+
+# Serializa a escrita no terminal quando vários dispositivos rodam em paralelo
+print_lock = threading.Lock()
+
+def log(device, message="", stream=None):
+    """Imprime uma mensagem prefixada com o dispositivo, sem misturar linhas entre threads."""
+    if stream is None:
+        stream = _real_stream(sys.stdout)
+    with print_lock:
+        for line in str(message).splitlines() or [""]:
+            print(f"[{device}] {line}" if device else line, file=stream, flush=True)
+
+# Estado da thread atual: dispositivo em execução e falhas de comunicação vistas na saída
+thread_state = threading.local()
+
+def _emit(device, lines, stream=None):
+    """Registra linhas de saída do esptool, anotando se indicam falha de comunicação."""
+    for line in lines:
+        if BAUD_CHANGED.match(line.strip()):
+            thread_state.baud_changed = True
+        elif (getattr(thread_state, "baud_changed", False) and "Failed to connect" not in line
+              and BAUD_FAILURE.search(line)):
+            thread_state.baud_failure = True
+    log(device, "\n".join(lines), stream=stream)
+
+class ThreadOutput(io.TextIOBase):
+    """Substitui sys.stdout/sys.stderr, encaminhando a saída de cada thread para log() com o seu dispositivo.
+    
+    O esptool escreve direto em sys.stdout, que é global ao processo; com vários
+    dispositivos em paralelo, é a thread que escreve que identifica o dispositivo.
+    """
+    
+    def __init__(self, stream):
+        self.stream = stream
+    
+    def write(self, text):
+        device = getattr(thread_state, "device", None)
+        if device is None:
+            return self.stream.write(text)
+        
+        # Cores e comandos de cursor não fazem sentido em linhas prefixadas e intercaladas
+        text = ANSI_ESCAPE.sub("", text)
+        *lines, thread_state.pending = TEXT_LINE_BREAK.split(thread_state.pending + text)
+        lines = [line for line in lines if line]
+        if lines:
+            _emit(device, lines, stream=self.stream)
+        return len(text)
+    
+    def flush(self):
+        self.stream.flush()
+    
+    def isatty(self):
+        return False
+
+def log_exception(device, message, error):
+    """Registra uma exceção inesperada de um dispositivo, com o traceback; chamar dentro do except."""
+    logger.exception("[%s] %s: %s", device, message, error)
+
+def _real_stream(stream):
+    """Retorna o stream original por trás de um ThreadOutput."""
+    return stream.stream if isinstance(stream, ThreadOutput) else stream
+
+def _install_thread_output():
+    """Instala ThreadOutput em sys.stdout e sys.stderr, uma única vez.
+    
+    Também desliga a saída "colapsável" do logger do esptool 5: ele apaga linhas já
+    impressas com códigos ANSI, contando-as num estado único para todas as threads,
+    o que apagaria linhas de outros dispositivos.
+    """
+    if esptool_log is not None:
+        esptool_log.set_verbosity("verbose")
+    with print_lock:
+        if not isinstance(sys.stdout, ThreadOutput):
+            sys.stdout = ThreadOutput(sys.stdout)
+        if not isinstance(sys.stderr, ThreadOutput):
+            sys.stderr = ThreadOutput(sys.stderr)
+
+# Prefixos dos nós em /dev usados pelos conversores USB-serial de cada sistema
+DEVICE_PREFIXES = {
+    'darwin': ('cu.usbserial', 'tty.usbserial'),
+    # ttyACM fica de fora: além de Arduinos, impressoras 3D e modems, as placas com USB
+    # nativo usam outros chips (o flasher só suporta o ESP32). Use --port para incluí-las.
+    'linux': ('ttyUSB',),
+}
 
 def find_esp32_devices():
     """Encontra todos os dispositivos ESP32 conectados."""
-    if sys.platform == 'darwin':  # macOS
-        devices = glob.glob('/dev/cu.usbserial*')
-        if not devices:
-            # Tenta outros padrões comuns no macOS
-            devices = glob.glob('/dev/tty.usbserial*')
-    elif sys.platform == 'linux':
-        devices = glob.glob('/dev/ttyUSB*')
-    elif sys.platform == 'win32':
+    if sys.platform == 'win32':
         import serial.tools.list_ports
-        devices = [p.device for p in serial.tools.list_ports.comports()]
-    else:
+        return [p.device for p in serial.tools.list_ports.comports()]
+    
+    if sys.platform not in DEVICE_PREFIXES:
         raise OSError(f"Sistema operacional não suportado: {sys.platform}")
     
+    # Percorre /dev uma única vez em vez de um glob por padrão
+    prefixes = DEVICE_PREFIXES[sys.platform]
+    with os.scandir('/dev') as entries:
+        devices = sorted(entry.path for entry in entries if entry.name.startswith(prefixes))
+    
+    if sys.platform == 'darwin':
+        # No macOS cada porta aparece como cu.* e tty.*; prefere cu.* quando existir
+        callout = [d for d in devices if os.path.basename(d).startswith('cu.')]
+        devices = callout or devices
+    
     return devices
 
-def run_esptool_command(args, timeout=300):
+@contextlib.contextmanager
+def _device_output(device):
+    """Encaminha o que o esptool imprimir na thread atual para log() com o prefixo do dispositivo."""
+    _install_thread_output()
+    thread_state.device = device
+    thread_state.pending = ""
+    try:
+        yield
+    finally:
+        if thread_state.pending:
+            _emit(device, [thread_state.pending])
+        thread_state.device = None
+
+def _retry_lower_baud(run, baud_rate, baud_fallback=(), device=None):
+    """Executa run(baud_rate) e, se a saída indicar falha de comunicação, repete
+    com a próxima taxa de baud_fallback menor que a atual.
+    
+    A última taxa tentada fica em thread_state.baud_rate, para que as etapas
+    seguintes do mesmo dispositivo já comecem pela taxa que funcionou."""
+    while True:
+        thread_state.baud_failure = False
+        thread_state.baud_changed = False
+        thread_state.baud_rate = baud_rate
+        success = run(baud_rate)
+        if success or not thread_state.baud_failure:
+            return success
+        
+        lower = [rate for rate in baud_fallback if rate < baud_rate]
+        if not lower:
+            return False
+        
+        log(device, f"Falha de comunicação a {baud_rate} baud; tentando novamente a {lower[0]} baud...")
+        baud_rate = lower[0]
+
+def run_esptool_command(args, device=None, timeout=300, baud_fallback=()):
+    """Executa um comando esptool e mostra o progresso em tempo real.
+    
+    Usa o esptool como módulo Python quando instalado, evitando iniciar um novo
+    interpretador a cada etapa; caso contrário, executa o esptool.py via subprocess.
+    Se a saída indicar falha de comunicação, repete o comando com a próxima taxa
+    de baud_fallback menor que a atual.
+    """
+    args = list(args)
+    
+    def run(baud_rate=None):
+        if baud_rate is not None:
+            args[args.index("--baud") + 1] = str(baud_rate)
+        if esptool is not None:
+            return _run_esptool_in_process(args, device)
+        return _run_esptool_subprocess(args, device, timeout)
+    
+    if "--baud" not in args:
+        return run()
+    return _retry_lower_baud(run, int(args[args.index("--baud") + 1]), baud_fallback, device)
+
+def _run_esptool_in_process(args, device=None):
+    """Executa um comando esptool chamando esptool.main() na thread atual."""
+    log(device, f"Executando comando: esptool {' '.join(args)}")
+    
+    try:
+        with _device_output(device):
+            # Cada chamada recebe sua própria lista de argumentos
+            esptool.main(list(args))
+        return True
+    except SystemExit as e:
+        # O esptool (via click) encerra com SystemExit mesmo em caso de sucesso
+        if e.code not in (None, 0):
+            log(device, f"Comando falhou com código de retorno: {e.code}")
+            return False
+        return True
+    except esptool.FatalError as e:
+        _emit(device, [f"Erro fatal do esptool: {e}"])
+        return False
+    except Exception as e:
+        log_exception(device, "Erro inesperado", e)
+        return False
+
+def _run_esptool_subprocess(args, device=None, timeout=300):
     """Executa um comando esptool usando subprocess e mostra o progresso em tempo real."""
     cmd = ["esptool.py"] + args
-    print(f"Executando comando: {' '.join(cmd)}")
+    log(device, f"Executando comando: {' '.join(cmd)}")
     
     try:
         # Inicia o processo
@@ -35,60 +248,56 @@ def run_esptool_command(args, timeout=300):
             cmd,
             stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,  # Redireciona stderr para stdout
-            text=True,
-            bufsize=1  # Linha por linha
+            text=False,
+            bufsize=0  # Sem buffer do Python; a leitura é feita direto no descritor
         )
         
-        # Lê e exibe a saída em tempo real
-        for line in iter(process.stdout.readline, ''):
-            print(line, end='')  # end='' porque a linha já tem \n
+        # Lê e exibe a saída em tempo real, em blocos. As barras de progresso do
+        # esptool usam \r, então quebra as linhas tanto em \n quanto em \r.
+        fd = process.stdout.fileno()
+        pending = b""
+        while True:
+            chunk = os.read(fd, READ_BUFFER_SIZE)
+            if not chunk:
+                break
+            *lines, pending = LINE_BREAK.split(pending + chunk)
+            lines = [line.decode(errors='replace') for line in lines if line]
+            if lines:
+                _emit(device, lines)
+        if pending:
+            _emit(device, [pending.decode(errors='replace')])
         
         # Espera o processo terminar
         process.stdout.close()
         return_code = process.wait()
         
         if return_code != 0:
-            print(f"Comando falhou com código de retorno: {return_code}")
+            log(device, f"Comando falhou com código de retorno: {return_code}")
             return False
         
         return True
     except Exception as e:
-        print(f"Erro inesperado: {e}")
-        import traceback
-        traceback.print_exc()
+        log_exception(device, "Erro inesperado", e)
         return False
 
-def erase_flash(device, baud_rate=115200):
+def erase_flash(device, baud_rate=DEFAULT_BAUD, baud_fallback=BAUD_FALLBACK):
     """Limpa toda a flash do dispositivo ESP32."""
-    print(f"\n{'='*37}")
-    print(f"Limpando flash do dispositivo: {device}")
-    print(f"{'='*37}")
+    log(device, f"{'='*37}")
+    log(device, f"Limpando flash do dispositivo: {device}")
+    log(device, f"{'='*37}")
     
     args = ["--chip", "esp32", "--port", device, "--baud", str(baud_rate), "erase_flash"]
-    return run_esptool_command(args)
+    return run_esptool_command(args, device, baud_fallback=baud_fallback)
 
-def upload_platformio_style(device, firmware_dir, baud_rate=115200):
-    """Faz upload do firmware no estilo PlatformIO."""
-    print(f"\n{'='*37}")
-    print(f"Fazendo upload do firmware para: {device}")
-    print(f"{'='*37}")
-    
-    # Verifica se os arquivos necessários existem
-    bootloader_path = os.path.join(firmware_dir, "bootloader.bin")
-    partitions_path = os.path.join(firmware_dir, "partitions.bin")
-    firmware_path = os.path.join(firmware_dir, "firmware.bin")
+def upload_platformio_style(device, bundle, baud_rate=DEFAULT_BAUD, erase_all=False, baud_fallback=BAUD_FALLBACK):
+    """Faz upload do firmware no estilo PlatformIO.
     
-    if not os.path.exists(bootloader_path):
-        print(f"Erro: bootloader.bin não encontrado em {firmware_dir}")
-        return False
-    
-    if not os.path.exists(partitions_path):
-        print(f"Erro: partitions.bin não encontrado em {firmware_dir}")
-        return False
-    
-    if not os.path.exists(firmware_path):
-        print(f"Erro: firmware.bin não encontrado em {firmware_dir}")
-        return False
+    Com erase_all=True a flash inteira é limpa na mesma invocação do esptool,
+    evitando um segundo handshake com o chip só para o erase_flash.
+    """
+    log(device, f"{'='*37}")
+    log(device, f"Fazendo upload do firmware para: {device}")
+    log(device, f"{'='*37}")
     
     # Constrói o comando para fazer upload de todos os arquivos
     args = [
@@ -98,27 +307,31 @@ def upload_platformio_style(device, firmware_dir, baud_rate=115200):
         "--before", "default_reset",
         "--after", "hard_reset",
         "write_flash",
-        "-z",
+        *(["--erase-all"] if erase_all else []),
+        # Sem -z/-u: o esptool comprime quando o stub está ativo e envia sem
+        # compressão caso contrário. A escolha vale para a invocação inteira, e
+        # separar bootloader/partições (-u) do firmware (-z) custaria um segundo
+        # handshake com o chip, mais lento que a compressão desses arquivos pequenos.
         "--flash_mode", "dio",
         "--flash_freq", "40m",
         "--flash_size", "detect",
-        "0x1000", bootloader_path,
-        "0x8000", partitions_path,
-        "0x10000", firmware_path
+        "0x1000", bundle.bootloader,
+        "0x8000", bundle.partitions,
+        "0x10000", bundle.firmware
     ]
     
-    return run_esptool_command(args)
+    return run_esptool_command(args, device, baud_fallback=baud_fallback)
 
-def verify_firmware(device, firmware_dir, baud_rate=115200):
-    """Verifica se o firmware foi carregado corretamente."""
-    print(f"\n{'='*37}")
-    print(f"Verificando firmware em: {device}")
-    print(f"{'='*37}")
+def verify_firmware(device, bundle, baud_rate=DEFAULT_BAUD, baud_fallback=BAUD_FALLBACK):
+    """Verifica se o firmware foi carregado corretamente com o verify_flash.
     
-    # Verifica se os arquivos necessários existem
-    bootloader_path = os.path.join(firmware_dir, "bootloader.bin")
-    partitions_path = os.path.join(firmware_dir, "partitions.bin")
-    firmware_path = os.path.join(firmware_dir, "firmware.bin")
+    O verify_flash compara o MD5 calculado pelo chip com o dos arquivos (só lê a
+    flash de volta se houver diferença). O write_flash já faz essa mesma checagem
+    em toda gravação; esta etapa separada só é executada com --verify.
+    """
+    log(device, f"{'='*37}")
+    log(device, f"Verificando firmware em: {device}")
+    log(device, f"{'='*37}")
     
     # Constrói o comando para verificar todos os arquivos
     args = [
@@ -126,67 +339,181 @@ def verify_firmware(device, firmware_dir, baud_rate=115200):
         "--port", device,
         "--baud", str(baud_rate),
         "verify_flash",
-        "0x1000", bootloader_path,
-        "0x8000", partitions_path,
-        "0x10000", firmware_path
+        "0x1000", bundle.bootloader,
+        "0x8000", bundle.partitions,
+        "0x10000", bundle.firmware
     ]
     
-    return run_esptool_command(args)
+    return run_esptool_command(args, device, baud_fallback=baud_fallback)
 
-def main():
-    parser = argparse.ArgumentParser(description='Ferramenta para limpar e programar ESP32')
-    parser.add_argument('--firmware-dir', type=str, help='Diretório contendo os arquivos de firmware (bootloader.bin, partitions.bin, firmware.bin)')
-    parser.add_argument('--erase-only', action='store_true', help='Apenas limpar a flash, sem fazer upload')
-    parser.add_argument('--verify', action='store_true', help='Verificar o firmware após o upload')
-    parser.add_argument('--baud', type=int, default=115200, help='Baud rate para comunicação (padrão: 115200)')
-    parser.add_argument('--skip-erase', action='store_true', help='Pular a etapa de limpeza da flash')
-    args = parser.parse_args()
+def flash_in_session(device, bundle, baud_rate=DEFAULT_BAUD, verify=False, erase=True, baud_fallback=BAUD_FALLBACK):
+    """Limpa, programa e verifica o dispositivo em uma única conexão com o chip.
     
-    # Verifica o diretório de firmware se não estiver no modo apenas-limpar
-    if not args.erase_only:
-        if args.firmware_dir is None:
-            print("Erro: Diretório de firmware não especificado.")
-            print("Use --firmware-dir CAMINHO ou --erase-only para apenas limpar.")
-            sys.exit(1)
-        
-        if not os.path.isdir(args.firmware_dir):
-            print(f"Erro: Diretório de firmware não encontrado: {args.firmware_dir}")
-            sys.exit(1)
-        
-        # Verifica se os arquivos necessários existem
-        bootloader_path = os.path.join(args.firmware_dir, "bootloader.bin")
-        partitions_path = os.path.join(args.firmware_dir, "partitions.bin")
-        firmware_path = os.path.join(args.firmware_dir, "firmware.bin")
-        
-        if not os.path.exists(bootloader_path):
-            print(f"Erro: bootloader.bin não encontrado em {args.firmware_dir}")
-            sys.exit(1)
-        
-        if not os.path.exists(partitions_path):
-            print(f"Erro: partitions.bin não encontrado em {args.firmware_dir}")
-            sys.exit(1)
+    Usa a API do esptool em vez da linha de comando: o handshake e o upload do
+    stub acontecem uma vez e todas as etapas reutilizam a mesma sessão.
+    """
+    log(device, f"{'='*37}")
+    log(device, f"Programando {device} em uma única sessão")
+    log(device, f"{'='*37}")
+    
+    if not _retry_lower_baud(
+        lambda rate: _flash_session(device, bundle, rate, verify, erase),
+        baud_rate, baud_fallback, device
+    ):
+        log(device, f"Falha ao programar o dispositivo {device}!")
+        return False
+    return True
+
+def _flash_session(device, bundle, baud_rate, verify, erase):
+    """Abre a porta, carrega o stub e executa write_flash/verify_flash na mesma sessão."""
+    flash_params = dict(flash_mode="dio", flash_freq="40m", flash_size="detect")
+    
+    try:
+        with _device_output(device), ESP32ROM(device) as esp:
+            esp.connect()
+            esp = run_stub(esp)
+            if baud_rate > ESP32ROM.ESP_ROM_BAUD:
+                esp.change_baud(baud_rate)
+                thread_state.baud_changed = True
+            attach_flash(esp)
+            
+            # Bootloader e partições são pequenos demais para compensar a compressão;
+            # o firmware principal segue com o padrão do esptool (comprimido com o stub)
+            write_flash(esp, [(0x1000, bundle.bootloader), (0x8000, bundle.partitions)],
+                        erase_all=erase, no_compress=True, **flash_params)
+            write_flash(esp, [(0x10000, bundle.firmware)], **flash_params)
+            log(device, f"Upload do firmware concluído com sucesso para {device}!")
+            
+            if verify:
+                log(device, "Verificando o firmware...")
+                verify_flash(esp, [(0x1000, bundle.bootloader), (0x8000, bundle.partitions),
+                                   (0x10000, bundle.firmware)], **flash_params)
+                log(device, f"Verificação do firmware concluída com sucesso para {device}!")
+            
+            reset_chip(esp, "hard-reset")
+        return True
+    except (esptool.FatalError, OSError) as e:
+        _emit(device, [f"Erro fatal do esptool: {e}"])
+        # Erros da porta serial depois da troca de taxa também contam como falha de comunicação
+        if thread_state.baud_changed and isinstance(e, OSError):
+            thread_state.baud_failure = True
+        return False
+
+def flash_all_in_one(device, bundle, baud_rate=DEFAULT_BAUD, verify=False, erase=True, reset_delay=0.5, baud_fallback=BAUD_FALLBACK):
+    """Limpa e programa o dispositivo em uma única invocação do esptool, verificando em seguida se solicitado.
+    
+    reset_delay é a espera, em segundos, entre o hard reset do upload e a verificação;
+    o verify_flash já reinicia o chip pelo DTR/RTS, então só precisa de uma folga curta.
+    verify=True repete, com o verify_flash, a checagem de MD5 que o write_flash já faz.
+    Com o esptool >= 5 instalado, tudo acontece em uma única sessão (flash_in_session),
+    sem reset entre upload e verificação, e reset_delay é ignorado.
+    """
+    if ESP32ROM is not None:
+        return flash_in_session(device, bundle, baud_rate, verify, erase, baud_fallback)
+    
+    if not upload_platformio_style(device, bundle, baud_rate, erase_all=erase, baud_fallback=baud_fallback):
+        log(device, f"Falha no upload do firmware para {device}!")
+        return False
+    
+    log(device, f"Upload do firmware concluído com sucesso para {device}!")
+    
+    # Continua na taxa em que o upload funcionou, sem repetir as que falharam
+    baud_rate = thread_state.baud_rate
+    
+    if verify:
+        if reset_delay > 0:
+            log(device, "Aguardando dispositivo reiniciar...")
+            time.sleep(reset_delay)
         
-        if not os.path.exists(firmware_path):
-            print(f"Erro: firmware.bin não encontrado em {args.firmware_dir}")
-            sys.exit(1)
+        log(device, "Verificando o firmware...")
+        if not verify_firmware(device, bundle, baud_rate, baud_fallback=baud_fallback):
+            log(device, f"Falha na verificação do firmware para {device}!")
+            return False
+        log(device, f"Verificação do firmware concluída com sucesso para {device}!")
+    
+    return True
+
+def _process_device(device, args, bundle):
+    """Limpa, programa e verifica um único dispositivo. Retorna (sucesso, dispositivo)."""
+    started = time.monotonic()
+    try:
+        if args.erase_only:
+            # Apenas limpa a flash, se não estiver pulando essa etapa
+            if not args.skip_erase:
+                if not erase_flash(device, args.baud, baud_fallback=args.baud_fallback):
+                    log(device, f"Falha ao limpar flash do dispositivo {device}")
+                    return False, device
+                log(device, "Flash limpa com sucesso!")
+        else:
+            # Limpeza e upload acontecem na mesma sessão com o chip
+            log(device, "Iniciando upload do firmware...")
+            if not flash_all_in_one(device, bundle, args.baud, args.verify, erase=not args.skip_erase,
+                                    reset_delay=args.reset_delay, baud_fallback=args.baud_fallback):
+                return False, device
         
-        print(f"Diretório de firmware: {args.firmware_dir}")
-        print(f"Bootloader: {os.path.getsize(bootloader_path)} bytes")
-        print(f"Partitions: {os.path.getsize(partitions_path)} bytes")
-        print(f"Firmware: {os.path.getsize(firmware_path)} bytes ({os.path.getsize(firmware_path)/1024:.1f} KB)")
+        return True, device
+    except Exception as e:
+        log_exception(device, "Erro ao processar dispositivo", e)
+        return False, device
+    finally:
+        logger.debug("[%s] Tempo total: %.1f s", device, time.monotonic() - started)
+
+def _require_file(path, firmware_dir):
+    """Retorna o os.stat de um arquivo de firmware, encerrando se ele não existir."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        st = None
+    if st is None or not stat.S_ISREG(st.st_mode):
+        print(f"Erro: {os.path.basename(path)} não encontrado em {firmware_dir}")
+        sys.exit(1)
+    return st
+
+def _load_firmware(args):
+    """Valida os arquivos de firmware e retorna o FirmwareBundle (None com --erase-only).
     
-    # Encontra dispositivos ESP32
-    devices = find_esp32_devices()
+    Todo acesso ao disco acontece aqui, uma vez por lote; os workers de cada
+    dispositivo só recebem o FirmwareBundle já validado.
+    """
+    # No modo apenas-limpar não há firmware a verificar
+    if args.erase_only:
+        return None
     
-    if not devices:
-        print("Nenhum dispositivo ESP32 encontrado.")
+    if args.firmware_dir is None:
+        print("Erro: Diretório de firmware não especificado.")
+        print("Use --firmware-dir CAMINHO ou --erase-only para apenas limpar.")
+        sys.exit(1)
+    
+    try:
+        is_dir = stat.S_ISDIR(os.stat(args.firmware_dir).st_mode)
+    except OSError:
+        is_dir = False
+    if not is_dir:
+        print(f"Erro: Diretório de firmware não encontrado: {args.firmware_dir}")
         sys.exit(1)
     
+    # Resolve os caminhos e obtém o tamanho com um único stat por arquivo
+    paths = {}
+    sizes = {}
+    for name in ("bootloader", "partitions", "firmware"):
+        path = os.path.join(args.firmware_dir, f"{name}.bin")
+        paths[name] = path
+        sizes[name] = _require_file(path, args.firmware_dir).st_size
+    bundle = FirmwareBundle(sizes=sizes, **paths)
+    
+    print(f"Diretório de firmware: {args.firmware_dir}")
+    print(f"Bootloader: {sizes['bootloader']} bytes")
+    print(f"Partitions: {sizes['partitions']} bytes")
+    print(f"Firmware: {sizes['firmware']} bytes ({sizes['firmware']/1024:.1f} KB)")
+    
+    return bundle
+
+def _preflight(args, devices):
+    """Exibe os dispositivos encontrados e monta a ação mostrada na confirmação."""
     print(f"Encontrados {len(devices)} dispositivos ESP32:")
     for i, device in enumerate(devices, 1):
         print(f"{i}. {device}")
     
-    # Confirmação do usuário
     if args.skip_erase:
         action = "programar" if not args.erase_only else "não fazer nada"
     else:
@@ -195,68 +522,83 @@ def main():
     if args.verify and not args.erase_only:
         action += " e verificar"
     
+    return action
+
+def main():
+    parser = argparse.ArgumentParser(description='Ferramenta para limpar e programar ESP32')
+    parser.add_argument('--firmware-dir', type=str, help='Diretório contendo os arquivos de firmware (bootloader.bin, partitions.bin, firmware.bin)')
+    parser.add_argument('--erase-only', action='store_true', help='Apenas limpar a flash, sem fazer upload')
+    parser.add_argument('--verify', action='store_true',
+                        help='Conferir novamente o MD5 da flash com o verify_flash após o upload (o upload já confere o MD5 de cada arquivo)')
+    parser.add_argument('--baud', type=int, default=DEFAULT_BAUD, help=f'Baud rate para comunicação (padrão: {DEFAULT_BAUD})')
+    parser.add_argument('--baud-fallback', type=int, nargs='*', default=list(BAUD_FALLBACK),
+                        help='Taxas menores tentadas, em ordem, se a comunicação falhar (padrão: 460800 230400 115200)')
+    parser.add_argument('--skip-erase', action='store_true', help='Pular a etapa de limpeza da flash')
+    parser.add_argument('--port', action='append', help='Porta serial a usar, sem busca automática (pode ser repetida)')
+    parser.add_argument('--reset-delay', type=float, default=0.5, help='Segundos de espera pelo reinício do dispositivo antes de verificar; só usado quando o esptool roda pela linha de comando (esptool < 5) (padrão: 0.5)')
+    parser.add_argument('--jobs', type=int, default=None, help='Número de dispositivos processados em paralelo (padrão: min(dispositivos, 2 x CPUs))')
+    parser.add_argument('--verbose', action='store_true', help='Exibir detalhes de depuração, como o tempo gasto em cada dispositivo')
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format="%(message)s")
+    
+    bundle = _load_firmware(args)
+    
+    # Encontra dispositivos ESP32, a menos que as portas tenham sido informadas
+    devices = args.port or find_esp32_devices()
+    
+    if not devices:
+        print("Nenhum dispositivo ESP32 encontrado.")
+        sys.exit(1)
+    
+    if args.jobs is None:
+        args.jobs = min(len(devices), (os.cpu_count() or 1) * 2)
+    elif args.jobs < 1:
+        print("Erro: --jobs deve ser maior ou igual a 1.")
+        sys.exit(1)
+    
+    action = _preflight(args, devices)
+    
+    # Confirmação do usuário, uma única vez para todo o lote
     confirm = input(f"\nDeseja {action} todos os {len(devices)} dispositivos? (s/n): ")
     
     if confirm.lower() != 's':
         print("Operação cancelada pelo usuário.")
         sys.exit(0)
     
-    # Processa cada dispositivo
-    processed = 0
-    failed = 0
+    # Prepara a saída do esptool antes de iniciar os workers
+    _install_thread_output()
     
-    for device in devices:
+    # Processa os dispositivos em paralelo, um worker por porta serial
+    cancelled = None
+    
+    with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(_process_device, device, args, bundle) for device in devices]
         try:
-            # Limpa a flash se não estiver pulando essa etapa
-            if not args.skip_erase:
-                if erase_flash(device, args.baud):
-                    print("Flash limpa com sucesso!")
-                    
-                    # Aguarda o dispositivo reiniciar
-                    print("Aguardando dispositivo reiniciar...")
-                    time.sleep(5)  # Aumentado para 5 segundos
-                else:
-                    print(f"Falha ao limpar flash do dispositivo {device}")
-                    failed += 1
-                    continue
-            
-            # Faz upload do firmware se necessário
-            if not args.erase_only:
-                print("Iniciando upload do firmware...")
-                if upload_platformio_style(device, args.firmware_dir, args.baud):
-                    print(f"Upload do firmware concluído com sucesso para {device}!")
-                    
-                    # Aguarda o dispositivo reiniciar
-                    print("Aguardando dispositivo reiniciar...")
-                    time.sleep(5)
-                    
-                    # Verifica o firmware se solicitado
-                    if args.verify:
-                        print("Verificando o firmware...")
-                        if verify_firmware(device, args.firmware_dir, args.baud):
-                            print(f"Verificação do firmware concluída com sucesso para {device}!")
-                            processed += 1
-                        else:
-                            print(f"Falha na verificação do firmware para {device}!")
-                            failed += 1
-                    else:
-                        processed += 1
-                else:
-                    print(f"Falha no upload do firmware para {device}!")
-                    failed += 1
-            else:
-                processed += 1
-        except Exception as e:
-            print(f"Erro ao processar dispositivo {device}: {e}")
-            failed += 1
-            import traceback
-            traceback.print_exc()
+            for future in as_completed(futures):
+                future.result()
+        except KeyboardInterrupt:
+            # Cancela os dispositivos que ainda não começaram; os em andamento não
+            # podem ser interrompidos no meio da gravação e são aguardados ao sair do with
+            cancelled = sum(future.cancel() for future in futures)
+            print(f"\nOperação interrompida pelo usuário. {cancelled} dispositivos não serão processados.")
+            print("Aguardando os dispositivos em andamento terminarem...")
+    
+    # Conta também os dispositivos que terminaram depois de uma interrupção
+    results = [future.result()[0] for future in futures if not future.cancelled()]
+    processed = results.count(True)
+    failed = results.count(False)
     
     # Relatório final
-    print("\nProcesso concluído.")
+    print("\nProcesso concluído." if cancelled is None else "\nProcesso interrompido.")
     print(f"Dispositivos processados com sucesso: {processed}")
     print(f"Dispositivos com falha: {failed}")
+    if cancelled is not None:
+        print(f"Dispositivos cancelados: {cancelled}")
     print(f"Total de dispositivos: {len(devices)}")
+    
+    if cancelled is not None:
+        sys.exit(130)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file